@@ -1,11 +1,19 @@
-from typing import List, Union
+import itertools
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple, Union
 
 import numpy as np
 from matplotlib.backend_bases import key_press_handler
-from matplotlib.cbook import CallbackRegistry
 from matplotlib.figure import Figure
-
-from ._util import ConflictingArgumentsError, list_to_onehot, onehot_to_list
+from matplotlib.transforms import Bbox
+
+from ._util import (
+    ConflictingArgumentsError,
+    class_indices,
+    flatten_labels,
+    onehot_to_list,
+)
 from ._widgets import button_array
 
 
@@ -31,6 +39,7 @@ class image_labeller:
         labelling_advances_image: bool = True,
         N_images=None,
         fig: Figure = None,
+        prefetch: bool = False,
         **imshow_kwargs,
     ):
         """
@@ -69,6 +78,10 @@ class image_labeller:
         fig : Figure
             An empty figure to build the UI in. Use this to embed image_labeller into
             a gui framework.
+        prefetch : bool, default: False
+            Whether to load the images before and after the current image in a
+            background thread. Only used if *images* is a Callable, which must
+            then be safe to call from another thread.
         **imshow_kwargs :
             kwargs to be passed to the imshow function that displays the images.
         """
@@ -87,29 +100,51 @@ class image_labeller:
         else:
             raise TypeError("Title must be a str or a Callable")
 
+        self._prefetch_pool: Union[ThreadPoolExecutor, None] = None
+        # index -> Future for the current image and its neighbours
+        self._prefetch_cache: Dict[int, Future] = {}
+        # every image in a numeric array has the same shape, so the extent only
+        # needs to be set once. Object arrays may hold images of any shape.
+        self._is_ndarray_path = (
+            isinstance(images, np.ndarray)
+            and images.dtype != object
+            and images.ndim >= 3
+        )
+        # don't preprocess memmaps as that would load every image into memory
+        self._in_memory = self._is_ndarray_path and not isinstance(images, np.memmap)
         if callable(images):
             if not isinstance(N_images, int):
                 raise TypeError(
                     "If images is a callable then N_images must be provided"
                 )
             self._N_images = N_images
-
-            def _get_image(i):
-                return self._images(i)
-
+            self._user_images = images
+            self._get_image = images
+            if prefetch:
+                self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
         else:
             self._N_images = len(images)
-
-            def _get_image(i):
-                return self._images[i]
-
-        self._get_image = _get_image
+            # callbacks are given the user's images rather than the copy below
+            self._user_images = images
+            if self._in_memory:
+                # copy once up front rather than every time an image is displayed.
+                # float32 halves the memory that needs to be normalized when drawing
+                dtype = np.float32 if images.dtype == np.float64 else None
+                self._images = np.ascontiguousarray(images, dtype=dtype)
+            self._get_image = self._images.__getitem__
 
         self._label_advances = labelling_advances_image
+        # formatted titles, reset when the labels of an image change in case
+        # a title function depends on them
+        self._title_cache = [None] * self._N_images
+        self._N_classes = len(classes)
 
-        # TODO: sync this up with labels
-        # TODO: make sure init_labels does something here
-        self._onehot = np.zeros((self._N_images, len(classes)), dtype=bool)
+        # single class labels are stored as an array of class indices (-1 for
+        # unlabelled) so only the multiclass case needs the onehot array
+        if self._multi:
+            # TODO: sync this up with labels
+            # TODO: make sure init_labels does something here
+            self._set_onehot(np.zeros((self._N_images, self._N_classes), dtype=bool))
 
         if label_keymap == "1234":
             if len(classes) > 10:
@@ -132,6 +167,18 @@ class image_labeller:
 
         # make array for easy indexing
         self._classes = np.asarray(classes)
+        # used to vectorize the lookup of class indices
+        self._sort_perm = np.argsort(self._classes)
+        # the original classes, indexing a list avoids creating numpy scalars
+        self._classes_py = list(classes)
+        self._classes_list = [str(klass) for klass in classes]
+        # index -1 maps to None for unlabelled images
+        self._classes_or_none = np.array(self._classes_py + [None], dtype=object)
+        # np.asarray converts mixed classes such as [1, "a"] to a common dtype,
+        # in that case look up labels against the original classes instead
+        self._class_lookup = None
+        if self._classes.tolist() != self._classes_py:
+            self._class_lookup = {klass: i for i, klass in enumerate(self._classes_py)}
 
         if init_labels is not None and init_labels_onehot is not None:
             raise ConflictingArgumentsError(
@@ -147,7 +194,7 @@ class image_labeller:
             if self._multi:
                 self.labels = [[]] * self._N_images
             else:
-                self.labels = [None] * self._N_images
+                self._label_idx = np.full(self._N_images, -1, dtype=np.int16)
 
         if fig is None:
             import matplotlib.pyplot as plt
@@ -156,15 +203,19 @@ class image_labeller:
         else:
             self._fig = fig
 
+        # savefig may temporarily swap out fig.canvas so keep the live canvas
+        self._canvas = self._fig.canvas
+
         # "remove" keys from the default keymap by overwriting the key handler method
         # see https://gitter.im/matplotlib/matplotlib?at=617988daee6c260cf743e9cb
-        self._fig.canvas.mpl_disconnect(self._fig.canvas.manager.key_press_handler_id)
+        self._canvas.mpl_disconnect(self._canvas.manager.key_press_handler_id)
 
-        self._fig.canvas.manager.key_press_handler_id = self._fig.canvas.mpl_connect(
+        self._canvas.manager.key_press_handler_id = self._canvas.mpl_connect(
             "key_press_event", gen_key_press_handler(list(self._label_keymap.keys()))
         )
 
         self._image_index = 0
+        self._displayed_index = 0
         if self._multi:
             self._image_ax, self._info_ax = self._fig.subplots(1, 2)
         else:
@@ -176,19 +227,41 @@ class image_labeller:
         aspect = imshow_kwargs.pop("aspect", "equal")
         self._vmin = imshow_kwargs.get("vmin", None)
         self._vmax = imshow_kwargs.get("vmax", None)
-        self._im = self._image_ax.imshow(
-            self._get_image(0), aspect=aspect, **imshow_kwargs
-        )
+        # precompute the color limits of every image rather than finding them
+        # each time an image is displayed
+        self._image_mins = None
+        self._image_maxs = None
+        if self._in_memory and self._images.ndim == 3:
+            # imshow doesn't accept vmin/vmax alongside a norm, in that case
+            # the norm is updated when the image changes
+            has_norm = "norm" in imshow_kwargs
+            if self._vmin is None:
+                self._image_mins = self._images.min(axis=(1, 2))
+                if not has_norm:
+                    imshow_kwargs["vmin"] = self._image_mins[0]
+            if self._vmax is None:
+                self._image_maxs = self._images.max(axis=(1, 2))
+                if not has_norm:
+                    imshow_kwargs["vmax"] = self._image_maxs[0]
+        if self._prefetch_pool is not None:
+            image = np.asarray(self._fetch_image(0))
+            self._prefetch()
+        else:
+            image = np.asarray(self._get_image(0))
+        self._last_shape = image.shape[:2]
+        self._im = self._image_ax.imshow(image, aspect=aspect, **imshow_kwargs)
 
         if self._multi:
 
             def on_state_change(new_state, old_state):
                 self._onehot[self._image_index] = new_state
+                self._title_cache[self._image_index] = None
                 # self.labels[self._image_index] = self._classes[new_state]
 
-            texts = []
-            for key, klass in zip(self._label_keymap.keys(), classes):
-                texts.append(f"[{key}]\n{str(klass)}")
+            texts = [
+                f"[{key}]\n{klass}"
+                for key, klass in zip(self._label_keymap.keys(), self._classes_list)
+            ]
             self._buttons = button_array(texts, self._info_ax)
             self._buttons.on_state_change(on_state_change)
         else:
@@ -217,9 +290,10 @@ class image_labeller:
                 horizontalalignment="left",
             )
 
-            textstr = """Class Keybindings:\n"""
-            for k, v in self._label_keymap.items():
-                textstr += f"{k} : {self._classes[v]}\n"
+            textstr = "Class Keybindings:\n" + "".join(
+                f"{k} : {self._classes_list[v]}\n"
+                for k, v in self._label_keymap.items()
+            )
 
             self._info_ax.text(
                 horiz_pos,
@@ -231,21 +305,57 @@ class image_labeller:
                 bbox=props,
             )
 
-            textstr = f"Current Class:\n{str(self._labels[0])}"
+            # pre-render the text for every class, the last entry is selected
+            # by unlabelled (-1) images
+            self._class_display_texts = [
+                f"Current Class:\n{klass}" for klass in self._classes_list + ["None"]
+            ]
             self._class_display = self._info_ax.text(
                 horiz_pos,
                 0.25,
-                textstr,
+                self._class_display_texts[self._label_idx[0]],
                 # transform=self._fig.transFigure,
                 fontsize=14,
                 verticalalignment="top",
                 bbox=props,
             )
 
+        # artists that change when only a label is assigned. These are redrawn on
+        # top of a cached background rather than redrawing the entire figure.
+        self._animated = []
+        self._bg = None
+        self._blit_bboxes = None
+        self._draw_pending = False
+        self._redraw_timer = self._canvas.new_timer(interval=0)
+        self._redraw_timer.single_shot = True
+        self._redraw_timer.add_callback(self._update_displayed)
+        if not self._multi and self._canvas.supports_blit:
+            self._animated = [self._image_ax.title, self._class_display]
+            for artist in self._animated:
+                artist.set_animated(True)
+
+        self._last_title = ""
         self._update_title()
 
-        self._fig.canvas.mpl_connect("key_press_event", self._key_press)
-        self._observers = CallbackRegistry()
+        self._canvas.mpl_connect("draw_event", self._on_draw)
+        self._canvas.mpl_connect("resize_event", self._on_resize)
+        self._canvas.mpl_connect("close_event", self._on_close)
+        # the configuration is fixed so choose how to assign labels once
+        # rather than checking it on every key press
+        self._nav_keys = {"left": -1, "right": 1}
+        if self._multi:
+            self._assign_label = self._assign_label_multi
+        elif self._label_advances:
+            self._assign_label = self._assign_label_single_advance
+        else:
+            self._assign_label = self._assign_label_single
+        self._canvas.mpl_connect("key_press_event", self._key_press)
+        # there are only two events so store their callbacks in plain lists
+        # rather than a CallbackRegistry to keep dispatching them cheap
+        # lists of (cid, func) pairs
+        self._image_changed_cbs: List[Tuple[int, Callable]] = []
+        self._label_assigned_cbs: List[Tuple[int, Callable]] = []
+        self._cid_gen = itertools.count()
 
     @property
     def ax(self):
@@ -260,9 +370,9 @@ class image_labeller:
         The current labels as a list of lists or a list of strings.
         """
         if self._multi:
-            return onehot_to_list(self._onehot, self._classes)
+            return onehot_to_list(self._onehot, self._classes_or_none[:-1])
         else:
-            return self._labels
+            return self._classes_or_none[self._label_idx].tolist()
 
     @labels.setter
     def labels(self, value):
@@ -270,10 +380,21 @@ class image_labeller:
             raise ValueError(
                 "Length of labels must be the same as the number of images"
             )
+        rows, values = flatten_labels(value)
         if self._multi:
-            self._onehot = list_to_onehot(value, self._classes)
+            onehot = np.zeros((self._N_images, self._N_classes), dtype=bool)
+            onehot[rows, self._class_indices(values)] = True
+            self._set_onehot(onehot)
         else:
-            self._labels = value
+            if len(set(rows)) != len(rows):
+                raise ValueError(
+                    "Each image can only have one label if multiclass is False"
+                )
+            # only replace the labels once the new ones are known to be valid
+            label_idx = np.full(self._N_images, -1, dtype=np.int16)
+            label_idx[rows] = self._class_indices(values)
+            self._label_idx = label_idx
+        self._title_cache = [None] * self._N_images
 
     @property
     def labels_onehot(self):
@@ -283,7 +404,9 @@ class image_labeller:
         if self._multi:
             return self._onehot
         else:
-            return list_to_onehot(self._labels, self._classes)
+            # the extra all False row is selected by unlabelled (-1) images
+            n_classes = len(self._classes)
+            return np.eye(n_classes + 1, n_classes, dtype=bool)[self._label_idx]
 
     @labels_onehot.setter
     def labels_onehot(self, value):
@@ -295,9 +418,26 @@ class image_labeller:
                 f"Expected shape {expected_shape} but got {value.shape}"
             )
         if self._multi:
-            self._onehot = value
+            self._set_onehot(value)
         else:
-            self._labels = onehot_to_list(value)
+            value = value.astype(bool)
+            label_idx = np.argmax(value, axis=1).astype(np.int16)
+            label_idx[~value.any(axis=1)] = -1
+            self._label_idx = label_idx
+        self._title_cache = [None] * self._N_images
+
+    def _class_indices(self, values):
+        if self._class_lookup is None:
+            return class_indices(values, self._classes, self._sort_perm)
+        unknown = [v for v in values if v not in self._class_lookup]
+        if unknown:
+            raise ValueError(f"Unknown classes: {unknown}")
+        return np.array([self._class_lookup[v] for v in values], dtype=np.intp)
+
+    def _set_onehot(self, value):
+        self._onehot = np.ascontiguousarray(value, dtype=bool)
+        # flat view for toggling a single label with one index
+        self._onehot_flat = self._onehot.ravel()
 
     @property
     def image_index(self):
@@ -308,82 +448,237 @@ class image_labeller:
 
     @image_index.setter
     def image_index(self, value):
+        self._set_image_index(value)
+
+    def _set_image_index(self, value, coalesce=False):
+        """
+        Change the displayed image. If *coalesce* is True and a draw is already
+        queued then only the index is updated, the image will be displayed
+        once the queued draw completes. This is only used for key presses so
+        that holding down a key doesn't build up a backlog of draws.
+        """
+        # clamp to the valid range of indices
+        if value < 0:
+            value = 0
+        elif value >= self._N_images:
+            value = self._N_images - 1
         if value == self._image_index:
             # quick return to avoid unnecessary draw
             return
-        elif value >= self._N_images:
-            if self._image_index == self._N_images - 1:
-                # quick return to avoid unnecessary draw
-                return
-            self._image_index = self._N_images - 1
-        elif value < 0:
-            if self._image_index == 0:
-                # quick return to avoid unnecessary draw
-                return
-            self._image_index = 0
-        else:
-            self._image_index = value
+        self._image_index = value
+        if coalesce and self._draw_pending:
+            return
         self._update_displayed()
 
     def _update_title(self):
-        text = self._title(self._image_index)
-        self._image_ax.set_title(text)
+        text = self._title_cache[self._image_index]
+        if text is None:
+            text = self._title(self._image_index)
+            self._title_cache[self._image_index] = text
+        if text != self._last_title:
+            # set_title marks the figure as stale so avoid it if possible
+            self._image_ax.set_title(text)
+            self._last_title = text
+
+    def _update_class_display(self):
+        label_idx = self._label_idx[self._image_index]
+        self._class_display.set_text(self._class_display_texts[label_idx])
+
+    def _draw_animated(self):
+        for artist in self._animated:
+            self._fig.draw_artist(artist)
+
+    def _draw_idle(self):
+        self._draw_pending = True
+        self._canvas.draw_idle()
+
+    def _on_draw(self, event):
+        if event.canvas is not self._canvas or self._canvas.is_saving():
+            # draws from savefig include the animated artists and may not be
+            # on a canvas that supports blitting
+            return
+        self._draw_pending = False
+        if self._displayed_index != self._image_index:
+            # the index changed while a draw was pending
+            self._redraw_timer.start()
+        # cache the background after every full draw so that label only updates
+        # can be blitted
+        if self._animated:
+            self._bg = self._canvas.copy_from_bbox(self._fig.bbox)
+            self._draw_animated()
+            self._blit_bboxes = self._animated_bboxes()
+
+    def _on_resize(self, event):
+        # the cached background no longer matches the canvas, it will be
+        # recreated by the draw following the resize
+        self._bg = None
+        self._blit_bboxes = None
+
+    def _animated_bboxes(self):
+        """
+        The regions of the canvas covered by each of the animated artists,
+        including the boxes drawn around text.
+        """
+        renderer = self._canvas.get_renderer()
+        bboxes = []
+        for artist in self._animated:
+            bbox = artist.get_window_extent(renderer)
+            patch = artist.get_bbox_patch()
+            if patch is not None:
+                bbox = Bbox.union([bbox, patch.get_window_extent(renderer)])
+            bboxes.append(bbox.padded(4))
+        return bboxes
+
+    def _update_title_blit(self):
+        """
+        Update the title and class display without redrawing the image.
+        Falls back to a full draw if there is no cached background.
+        """
+        self._update_title()
+        if not self._multi:
+            self._update_class_display()
+        if self._draw_pending:
+            # the queued draw will pick up the new text
+            return
+        if self._multi or self._bg is None or self._fig.stale:
+            # a callback may have changed other parts of the figure
+            self._draw_idle()
+            return
+        canvas = self._canvas
+        canvas.restore_region(self._bg)
+        self._draw_animated()
+        # only push the pixels that may have changed, this must include where
+        # the old text was in case the new text is smaller
+        bboxes = self._animated_bboxes()
+        for old, new in zip(self._blit_bboxes, bboxes):
+            canvas.blit(Bbox.union([old, new]))
+        self._blit_bboxes = bboxes
+
+    def _fetch_image(self, i):
+        """
+        Get image *i* from the prefetch cache, loading it if is not there.
+        """
+        future = self._prefetch_cache.get(i)
+        if future is None:
+            future = Future()
+            future.set_result(self._get_image(i))
+            self._prefetch_cache[i] = future
+        try:
+            return future.result()
+        except Exception:
+            # don't keep failed loads around so that they can be retried
+            del self._prefetch_cache[i]
+            raise
+
+    def _prefetch(self):
+        """
+        Start loading the images on either side of the current image and drop
+        any others from the cache.
+        """
+        pool = self._prefetch_pool
+        assert pool is not None
+        i = self._image_index
+        for idx in list(self._prefetch_cache):
+            if abs(idx - i) > 1:
+                self._prefetch_cache.pop(idx).cancel()
+        for idx in (i + 1, i - 1):
+            if 0 <= idx < self._N_images and idx not in self._prefetch_cache:
+                self._prefetch_cache[idx] = pool.submit(self._get_image, idx)
+
+    def _on_close(self, event):
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.shutdown(wait=False)
+            self._prefetch_pool = None
+            self._prefetch_cache.clear()
 
     def _update_displayed(self):
-        image = np.asarray(self._get_image(self._image_index))
-        # for some reason this keeps getting turned off by something
-        self._image_ax.set_autoscale_on(True)
+        self._displayed_index = self._image_index
+        if self._is_ndarray_path:
+            image = self._get_image(self._image_index)
+        elif self._prefetch_pool is not None:
+            image = np.asarray(self._fetch_image(self._image_index))
+            # load the neighbours while this image is drawn
+            self._prefetch()
+        else:
+            image = np.asarray(self._get_image(self._image_index))
         self._im.set_data(image)
 
         # autoscaling of colormaps if necessary
         if image.ndim != 3:
-            if self._vmin is None:
+            if self._image_mins is not None:
+                self._im.norm.vmin = self._image_mins[self._image_index]
+            elif self._vmin is None:
                 self._im.norm.vmin = image.min()
-            if self._vmax is None:
+            if self._image_maxs is not None:
+                self._im.norm.vmax = self._image_maxs[self._image_index]
+            elif self._vmax is None:
                 self._im.norm.vmax = image.max()
 
-        self._im.set_extent((-0.5, image.shape[1] - 0.5, image.shape[0] - 0.5, -0.5))
+        # set_extent triggers autoscaling so only call it if the shape changed
+        if not self._is_ndarray_path and image.shape[:2] != self._last_shape:
+            self._last_shape = image.shape[:2]
+            # for some reason this keeps getting turned off by something
+            self._image_ax.set_autoscale_on(True)
+            self._im.set_extent(
+                (-0.5, image.shape[1] - 0.5, image.shape[0] - 0.5, -0.5)
+            )
         self._update_title()
-        self._observers.process("image-changed", self._image_index, image)
+        if self._image_changed_cbs and self._images is not self._user_images:
+            image = self._user_images[self._image_index]
+        for _, func in self._image_changed_cbs:
+            try:
+                func(self._image_index, image)
+            except Exception:
+                traceback.print_exc()
         if self._multi:
             with self._buttons.no_callbacks():
                 # TODO: check that this no_callbacks actually works....
                 new_state = self._onehot[self._image_index]
                 self._buttons.set_states(new_state)
         else:
-            textstr = f"Current Class:\n{str(self._labels[self._image_index])}"
-            self._class_display.set_text(textstr)
-        self._fig.canvas.draw_idle()
+            self._update_class_display()
+        self._draw_idle()
 
     def _key_press(self, event):
-        if event.key == "left":
-            self.image_index -= 1
-        elif event.key == "right":
-            self.image_index += 1
-        elif event.key in self._label_keymap:
-            which_label = self._label_keymap[event.key]
-            klass = self._classes[which_label]
-            if self._multi:
-                img_labels = self._onehot[self._image_index]
-                img_labels[which_label] = not img_labels[which_label]
-                self._buttons.set_states(img_labels)
-            else:
-                self._labels[self._image_index] = klass
-            self._observers.process("label-assigned", self._image_index, klass)
-            if self._label_advances and not self._multi:
-                if self.image_index == self._N_images - 1:
-                    # make sure we update the title we are on the last image
-                    self._update_title()
-                    textstr = f"Current Class:\n{str(self._labels[self._image_index])}"
-                    self._class_display.set_text(textstr)
-                    self._fig.canvas.draw_idle()
-                else:
-                    self.image_index += 1
-            else:
-                # only updating the text
-                self._update_title()
-                # TODO: blit just the text here
-                self._fig.canvas.draw_idle()
+        step = self._nav_keys.get(event.key)
+        if step is not None:
+            self._set_image_index(self._image_index + step, coalesce=True)
+            return
+        which_label = self._label_keymap.get(event.key)
+        if which_label is not None:
+            self._assign_label(which_label)
+
+    def _label_assigned(self, which_label):
+        self._title_cache[self._image_index] = None
+        klass = self._classes_py[which_label]
+        for _, func in self._label_assigned_cbs:
+            try:
+                func(self._image_index, klass)
+            except Exception:
+                # don't let a broken callback stop the display from updating
+                traceback.print_exc()
+
+    def _assign_label_multi(self, which_label):
+        flat_idx = self._image_index * self._N_classes + which_label
+        self._onehot_flat[flat_idx] ^= True
+        self._buttons.set_states(self._onehot[self._image_index])
+        self._label_assigned(which_label)
+        self._update_title_blit()
+
+    def _assign_label_single(self, which_label):
+        self._label_idx[self._image_index] = which_label
+        self._label_assigned(which_label)
+        # only updating the text
+        self._update_title_blit()
+
+    def _assign_label_single_advance(self, which_label):
+        self._label_idx[self._image_index] = which_label
+        self._label_assigned(which_label)
+        if self._image_index == self._N_images - 1:
+            # make sure we update the title we are on the last image
+            self._update_title_blit()
+        else:
+            self._set_image_index(self._image_index + 1, coalesce=True)
 
     def on_label_assigned(self, func):
         """
@@ -401,7 +696,9 @@ class image_labeller:
         int
             Connection id (which can be used to disconnect *func*).
         """
-        return self._observers.connect("label-assigned", lambda *args: func(*args))
+        cid = next(self._cid_gen)
+        self._label_assigned_cbs.append((cid, func))
+        return cid
 
     def on_image_changed(self, func):
         """
@@ -421,4 +718,22 @@ class image_labeller:
         int
             Connection id (which can be used to disconnect *func*).
         """
-        return self._observers.connect("image-changed", lambda *args: func(*args))
+        cid = next(self._cid_gen)
+        self._image_changed_cbs.append((cid, func))
+        return cid
+
+    def disconnect(self, cid):
+        """
+        Disconnect a callback connected with `on_label_assigned` or
+        `on_image_changed`.
+
+        Parameters
+        ----------
+        cid : int
+            The connection id returned when the callback was connected.
+        """
+        for callbacks in (self._image_changed_cbs, self._label_assigned_cbs):
+            for i, (func_cid, _) in enumerate(callbacks):
+                if func_cid == cid:
+                    del callbacks[i]
+                    return
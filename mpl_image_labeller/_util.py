@@ -7,6 +7,8 @@ from matplotlib.cbook import CallbackRegistry
 __all__ = [
     "deactivatable_CallbackRegistry",
     "add_text_to_rect",
+    "flatten_labels",
+    "class_indices",
     "list_to_onehot",
     "onehot_to_list",
     "ConflictingArgumentsError",
@@ -47,26 +49,63 @@ def add_text_to_rect(text, rect, **text_kwargs):
     rect.axes.annotate(text, (cx, cy), ha=ha, va=va, **text_kwargs)
 
 
-def list_to_onehot(labels, classes):
-    lookup = {c: i for i, c in enumerate(classes)}
-    arr = np.zeros((len(labels), len(classes)), dtype=bool)
-    for i, l in enumerate(labels):
-
-        if isinstance(l, str) or not isinstance(l, Iterable):
+def flatten_labels(labels):
+    """
+    Flatten a list of labels into two lists of the image index and the class.
+    Each label may be a single class, an iterable of classes, or None.
+    """
+    rows = []
+    values = []
+    for i, label in enumerate(labels):
+        if label is None:
+            continue
+        elif isinstance(label, str) or not isinstance(label, Iterable):
             # str, or number, or something like that
-            arr[i, lookup[l]] = True
+            rows.append(i)
+            values.append(label)
         else:
-            for j in l:
-                arr[i, lookup[j]] = True
+            label = list(label)
+            rows.extend([i] * len(label))
+            values.extend(label)
+    return rows, values
+
+
+def class_indices(values, classes, sort_perm=None):
+    """
+    Find the index in *classes* of each of *values*. *sort_perm* is the
+    result of ``np.argsort(classes)``, pass it in to avoid recomputing it.
+    """
+    classes = np.asarray(classes)
+    if sort_perm is None:
+        sort_perm = np.argsort(classes)
+    values = np.asarray(values)
+    if values.size == 0:
+        return np.zeros(0, dtype=np.intp)
+    classes_sorted = classes[sort_perm]
+    idx = np.searchsorted(classes_sorted, values)
+    idx[idx == len(classes)] = 0
+    unknown = classes_sorted[idx] != values
+    if unknown.any():
+        raise ValueError(f"Unknown classes: {values[unknown].tolist()}")
+    return sort_perm[idx]
+
+
+def list_to_onehot(labels, classes, sort_perm=None):
+    rows, values = flatten_labels(labels)
+    arr = np.zeros((len(labels), len(classes)), dtype=bool)
+    arr[rows, class_indices(values, classes, sort_perm)] = True
     return arr
 
 
 def onehot_to_list(onehot, classes):
-    c_arr = np.asarray(classes)
-    labels = []
-    for row in onehot:
-        labels.append(list(c_arr[row]))
-    return labels
+    onehot = np.asarray(onehot, dtype=bool)
+    if onehot.shape[0] == 0:
+        # np.split would give back a single empty row
+        return []
+    _, cols = np.nonzero(onehot)
+    splits = np.cumsum(onehot.sum(axis=1))[:-1]
+    labels = np.asarray(classes)[cols]
+    return [row.tolist() for row in np.split(labels, splits)]
 
 
 class ConflictingArgumentsError(ValueError):
@@ -83,9 +83,7 @@ class button_array:
 
         Maybe todo: also send the diff of the state.
         """
-        self._observers.connect(
-            "state-changed", lambda new_state, old_state: func(new_state, old_state)
-        )
+        return self._observers.connect("state-changed", func)
 
     def _on_pick(self, event):
         if event.artist in self._buttons:
@@ -1,6 +1,14 @@
+import threading
+from concurrent import futures
+
+import matplotlib.pyplot as plt
 import numpy as np
+import pytest
+from matplotlib.backend_bases import CloseEvent, KeyEvent
+from matplotlib.colors import LogNorm
 
 from mpl_image_labeller import image_labeller
+from mpl_image_labeller._util import list_to_onehot, onehot_to_list
 
 N = 5
 M = 3
@@ -11,6 +19,12 @@ im2[0, 0] = 0.5
 ims = [im1, im2]
 
 
+@pytest.fixture(autouse=True)
+def close_figures():
+    yield
+    plt.close("all")
+
+
 # norm and extent
 def test_norm_and_extent_updates():
     labeller = image_labeller(ims, ["good", "bad"])
@@ -49,3 +63,312 @@ def test_norm_with_explict_vmin_vmax():
     labeller.image_index += 1
     assert labeller._im.norm.vmin == im2.min()
     assert labeller._im.norm.vmax == 4
+
+
+def test_onehot_conversions():
+    classes = ["good", "bad", "meh"]
+    labels = [["good"], ["meh", "bad"], [], "bad"]
+    onehot = list_to_onehot(labels, classes)
+    np.testing.assert_array_equal(onehot, [[1, 0, 0], [0, 1, 1], [0, 0, 0], [0, 1, 0]])
+    assert onehot_to_list(onehot, classes) == [["good"], ["bad", "meh"], [], ["bad"]]
+
+    # None means an image is unlabelled
+    onehot = list_to_onehot(["meh", None, "good"], classes)
+    np.testing.assert_array_equal(onehot, [[0, 0, 1], [0, 0, 0], [1, 0, 0]])
+
+    # no images
+    assert onehot_to_list(np.zeros((0, 3), dtype=bool), classes) == []
+
+    with pytest.raises(ValueError):
+        list_to_onehot(["good", "not a class"], classes)
+
+
+def test_single_class_labels():
+    labeller = image_labeller(ims, ["good", "bad"], init_labels=["bad", None])
+    assert labeller.labels == ["bad", None]
+    np.testing.assert_array_equal(labeller.labels_onehot, [[0, 1], [0, 0]])
+
+    labeller.labels_onehot = [[1, 0], [0, 1]]
+    assert labeller.labels == ["good", "bad"]
+
+
+def test_norm_updates_ndarray():
+    images = np.stack([im1, im1 * 3])
+    labeller = image_labeller(images, ["good", "bad"])
+    assert labeller._im.norm.vmin == 0
+    assert labeller._im.norm.vmax == 1
+    labeller.image_index += 1
+    assert labeller._im.norm.vmin == 0
+    assert labeller._im.norm.vmax == 3
+
+    labeller = image_labeller(images, ["good", "bad"], vmax=2)
+    labeller.image_index += 1
+    assert labeller._im.norm.vmin == 0
+    assert labeller._im.norm.vmax == 2
+
+
+def test_image_changed_callback():
+    labeller = image_labeller(ims, ["good", "bad"])
+    calls = []
+    cid = labeller.on_image_changed(lambda idx, image: calls.append(idx))
+    labeller.image_index += 1
+    labeller.disconnect(cid)
+    labeller.image_index -= 1
+    assert calls == [1]
+
+
+def test_label_blit_matches_full_draw(tmp_path):
+    fig = plt.figure()
+    labeller = image_labeller(
+        ims, ["good", "bad"], labelling_advances_image=False, fig=fig
+    )
+    canvas = fig.canvas
+    canvas.draw()
+    # saving must not break blitting or be cached as the background
+    fig.savefig(tmp_path / "labeller.png")
+    fig.savefig(tmp_path / "labeller.pdf")
+
+    KeyEvent("key_press_event", canvas, "2")._process()
+    assert labeller.labels == ["bad", None]
+    blitted = np.asarray(canvas.buffer_rgba()).copy()
+    canvas.draw()
+    np.testing.assert_array_equal(blitted, np.asarray(canvas.buffer_rgba()))
+
+
+def test_label_callback_changes_are_drawn():
+    fig = plt.figure()
+    labeller = image_labeller(
+        ims, ["good", "bad"], labelling_advances_image=False, fig=fig
+    )
+    canvas = fig.canvas
+    canvas.draw()
+    assert not fig.stale
+
+    txt = labeller.ax.text(0, 0, "")
+    canvas.draw()
+    labeller.on_label_assigned(lambda idx, klass: txt.set_text(klass))
+    KeyEvent("key_press_event", canvas, "2")._process()
+    assert not fig.stale
+
+
+def test_image_index_with_pending_draw():
+    images = np.arange(5 * 3 * 3).reshape(5, 3, 3)
+    labeller = image_labeller(images, ["good", "bad"])
+    canvas = labeller._fig.canvas
+    # simulate a backend where the queued draw has not happened yet
+    canvas.draw_idle = lambda *args, **kwargs: None
+    calls = []
+    labeller.on_image_changed(lambda idx, image: calls.append(idx))
+
+    # programmatic changes always update the image
+    labeller.image_index = 1
+    labeller.image_index = 2
+    labeller.image_index = 3
+    assert calls == [1, 2, 3]
+    np.testing.assert_array_equal(labeller._im.get_array(), images[3])
+
+    # held down keys only update the index until the queued draw completes
+    for _ in range(3):
+        KeyEvent("key_press_event", canvas, "left")._process()
+    assert labeller.image_index == 0
+    assert calls == [1, 2, 3]
+    canvas.draw()
+    labeller._redraw_timer._on_timer()
+    assert calls == [1, 2, 3, 0]
+    np.testing.assert_array_equal(labeller._im.get_array(), images[0])
+
+
+def test_extent_updates_object_array():
+    images = np.empty(2, dtype=object)
+    images[0] = im1
+    images[1] = im2
+    labeller = image_labeller(images, ["good", "bad"])
+    labeller.image_index += 1
+    assert tuple(labeller._im.get_extent()) == (-0.5, N - 0.5, M - 0.5, -0.5)
+
+
+def test_ndarray_with_norm():
+    images = np.stack([im1 + 1, im1 * 3 + 1])
+    labeller = image_labeller(images, ["good", "bad"], norm=LogNorm())
+    assert labeller._im.norm.vmin == 1
+    assert labeller._im.norm.vmax == 2
+    labeller.image_index += 1
+    assert labeller._im.norm.vmin == 1
+    assert labeller._im.norm.vmax == 4
+
+
+def test_image_changed_gets_original_images():
+    images = np.stack([im1, im1 * 3])
+    labeller = image_labeller(images, ["good", "bad"])
+    received = []
+    labeller.on_image_changed(lambda idx, image: received.append(image))
+    labeller.image_index += 1
+    assert received[0].dtype == np.float64
+    np.testing.assert_array_equal(received[0], images[1])
+
+
+class _Loader:
+    def __init__(self, fail_once=()):
+        self.calls = []
+        self._fail_once = set(fail_once)
+
+    def __call__(self, idx):
+        self.calls.append((idx, threading.current_thread()))
+        if idx in self._fail_once:
+            self._fail_once.remove(idx)
+            raise OSError(f"could not load {idx}")
+        return np.full((3, 3), idx, dtype=float)
+
+
+def _wait_for_prefetch(labeller):
+    futures.wait(list(labeller._prefetch_cache.values()))
+
+
+def test_no_prefetch_by_default():
+    loader = _Loader()
+    labeller = image_labeller(loader, ["good", "bad"], N_images=5)
+    labeller.image_index = 2
+    assert labeller._prefetch_pool is None
+    assert [idx for idx, _ in loader.calls] == [0, 2]
+    assert all(t is threading.main_thread() for _, t in loader.calls)
+
+
+def test_prefetch_neighbours():
+    loader = _Loader()
+    labeller = image_labeller(loader, ["good", "bad"], N_images=5, prefetch=True)
+    _wait_for_prefetch(labeller)
+    assert sorted(labeller._prefetch_cache) == [0, 1]
+
+    labeller.image_index = 1
+    _wait_for_prefetch(labeller)
+    assert sorted(labeller._prefetch_cache) == [0, 1, 2]
+
+    labeller.image_index = 3
+    _wait_for_prefetch(labeller)
+    assert sorted(labeller._prefetch_cache) == [2, 3, 4]
+    np.testing.assert_array_equal(labeller._im.get_array(), np.full((3, 3), 3))
+    # every image was only loaded once
+    assert sorted(idx for idx, _ in loader.calls) == [0, 1, 2, 3, 4]
+
+
+def test_prefetch_failure_is_retried():
+    loader = _Loader(fail_once=[1])
+    labeller = image_labeller(loader, ["good", "bad"], N_images=3, prefetch=True)
+    _wait_for_prefetch(labeller)
+    with pytest.raises(OSError):
+        labeller.image_index = 1
+    assert 1 not in labeller._prefetch_cache
+
+    labeller.image_index = 0
+    _wait_for_prefetch(labeller)
+    labeller.image_index = 1
+    np.testing.assert_array_equal(labeller._im.get_array(), np.full((3, 3), 1))
+    assert [idx for idx, _ in loader.calls].count(1) == 2
+
+
+def test_prefetch_shutdown_on_close():
+    labeller = image_labeller(_Loader(), ["good", "bad"], N_images=3, prefetch=True)
+    pool = labeller._prefetch_pool
+    CloseEvent("close_event", labeller._fig.canvas)._process()
+    assert labeller._prefetch_pool is None
+    assert labeller._prefetch_cache == {}
+    with pytest.raises(RuntimeError):
+        pool.submit(print)
+
+
+def test_disconnect_same_function_twice():
+    labeller = image_labeller(ims, ["good", "bad"], labelling_advances_image=False)
+    calls = []
+
+    def callback(idx, value):
+        calls.append(value)
+
+    image_cid = labeller.on_image_changed(callback)
+    label_cid = labeller.on_label_assigned(callback)
+    assert image_cid != label_cid
+    labeller.disconnect(label_cid)
+
+    KeyEvent("key_press_event", labeller._fig.canvas, "2")._process()
+    assert calls == []
+    labeller.image_index += 1
+    assert len(calls) == 1
+
+
+def test_invalid_single_class_labels():
+    images = np.zeros((3, 4, 4))
+    labeller = image_labeller(images, ["a", "b"], init_labels=["a", "b", "a"])
+    with pytest.raises(ValueError):
+        labeller.labels = ["a", "typo", "b"]
+    assert labeller.labels == ["a", "b", "a"]
+
+    with pytest.raises(ValueError):
+        labeller.labels = [["a", "b"], None, None]
+    assert labeller.labels == ["a", "b", "a"]
+
+    # a single class inside a list is fine
+    labeller.labels = [["b"], None, "a"]
+    assert labeller.labels == ["b", None, "a"]
+
+
+def test_mixed_type_classes():
+    images = np.zeros((2, 4, 4))
+    labeller = image_labeller(images, [1, "a"], init_labels=[1, None])
+    assert labeller.labels == [1, None]
+    labeller.labels = labeller.labels
+    assert labeller.labels == [1, None]
+
+    labeller = image_labeller(images, [1, "a"], multiclass=True, init_labels=[[1], []])
+    assert labeller.labels == [[1], []]
+    labeller.labels = labeller.labels
+    assert labeller.labels == [[1], []]
+
+
+def test_multiclass_toggle():
+    images = np.zeros((2, 4, 4))
+    labeller = image_labeller(
+        images,
+        ["good", "bad", "meh"],
+        multiclass=True,
+        init_labels_onehot=[[0, 0, 1], [0, 0, 0]],
+    )
+    assert labeller._assign_label == labeller._assign_label_multi
+    assert labeller.labels_onehot.dtype == bool
+    canvas = labeller._fig.canvas
+
+    KeyEvent("key_press_event", canvas, "1")._process()
+    KeyEvent("key_press_event", canvas, "2")._process()
+    assert labeller.image_index == 0
+    assert labeller.labels == [["good", "bad", "meh"], []]
+
+    # toggle off again
+    KeyEvent("key_press_event", canvas, "3")._process()
+    KeyEvent("key_press_event", canvas, "1")._process()
+    assert labeller.labels == [["bad"], []]
+    np.testing.assert_array_equal(labeller.labels_onehot, [[0, 1, 0], [0, 0, 0]])
+    assert labeller._buttons.get_states() == [False, True, False]
+
+
+def test_labelling_advances_image():
+    images = np.zeros((3, 4, 4))
+    labeller = image_labeller(images, ["good", "bad"])
+    assert labeller._assign_label == labeller._assign_label_single_advance
+    canvas = labeller._fig.canvas
+    canvas.draw()
+
+    KeyEvent("key_press_event", canvas, "1")._process()
+    assert labeller.image_index == 1
+    KeyEvent("key_press_event", canvas, "2")._process()
+    assert labeller.image_index == 2
+    assert labeller._class_display.get_text() == "Current Class:\nNone"
+
+    # labelling the last image stays there but still shows the new label
+    KeyEvent("key_press_event", canvas, "2")._process()
+    assert labeller.image_index == 2
+    assert labeller._class_display.get_text() == "Current Class:\nbad"
+    assert labeller.labels == ["good", "bad", "bad"]
+
+    labeller = image_labeller(images, ["good", "bad"], labelling_advances_image=False)
+    assert labeller._assign_label == labeller._assign_label_single
+    KeyEvent("key_press_event", labeller._fig.canvas, "1")._process()
+    assert labeller.image_index == 0
+    assert labeller.labels == ["good", None, None]